@@ -5,15 +5,24 @@ Silent-CRDT 本地多节点同步测试脚本 (Python 版本)
 """
 
 import os
+import atexit
 import sys
 import time
 import json
 import signal
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Optional, Dict, List
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，缺失时回退到标准库 json
+    orjson = None
+
 # 配置
 PORT1 = 8080
 PORT2 = 8081
@@ -22,10 +31,41 @@ NODE2_ID = "node2"
 DATA_DIR1 = "./test_data/node1"
 DATA_DIR2 = "./test_data/node2"
 TIMEOUT = 30
-WAIT_TIME = 2
+SYNC_TIMEOUT = 5
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+# 与 cargo 一致：CARGO_TARGET_DIR 为相对路径时相对于项目根目录
+TARGET_DIR = PROJECT_ROOT / os.environ.get("CARGO_TARGET_DIR", "target")
+BINARY = (
+    TARGET_DIR
+    / "release"
+    / ("silent-crdt.exe" if sys.platform == "win32" else "silent-crdt")
+)
 
 # 全局进程列表
 processes = []
+# 清理是否已执行，保证 cleanup 幂等
+_cleaned = False
+# 通知后台轮询线程尽快退出
+_stop = threading.Event()
+
+# 全局 HTTP 会话，复用到各节点的 keep-alive 连接
+SESSION = requests.Session()
+SESSION.mount(
+    "http://", HTTPAdapter(pool_connections=2, pool_maxsize=10, max_retries=0)
+)
+SESSION.headers.update({"Connection": "keep-alive"})
+# 本地回环上的小体积 JSON 无需压缩
+SESSION.headers["Accept-Encoding"] = "identity"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# 预先拼接各节点的接口地址
+ENDPOINTS = {
+    port: {
+        name: f"http://127.0.0.1:{port}/{name}"
+        for name in ("health", "sync", "sync-peer", "state", "state-hash")
+    }
+    for port in (PORT1, PORT2)
+}
 
 
 class Colors:
@@ -38,35 +78,83 @@ class Colors:
     NC = "\033[0m"  # No Color
 
 
+# 预先拼接的横幅
+_RULE = "=" * 50
+BANNER = f"{Colors.GREEN}{_RULE}\nSilent-CRDT 本地多节点同步测试\n{_RULE}{Colors.NC}\n"
+SUCCESS_BANNER = f"{Colors.GREEN}{_RULE}\n✓✓✓ 所有测试通过！\n{_RULE}{Colors.NC}\n"
+
+
 def print_colored(message: str, color: str = Colors.NC):
     """打印彩色消息"""
-    print(f"{color}{message}{Colors.NC}")
+    # 单次写入，避免多线程输出时颜色码与消息被拆开
+    sys.stdout.write(color + message + Colors.NC + "\n")
+    # 错误信息立即刷新，避免与 stderr 上的回溯交错
+    if color == Colors.RED:
+        sys.stdout.flush()
+
+
+def parse_json(content: bytes):
+    """解析 JSON 响应体"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def encode_json(data) -> bytes:
+    """将数据编码为紧凑的 JSON 请求体"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def format_json(data) -> str:
+    """格式化 JSON 用于输出"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(data, indent=2)
 
 
 def cleanup():
     """清理测试环境"""
+    global _cleaned
+    if _cleaned:
+        return
+    _cleaned = True
+    # 清理期间忽略后续中断信号，保证清理完整执行
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _stop.set()
+
     print_colored("\n清理测试环境...", Colors.YELLOW)
 
-    # 停止所有子进程
+    # 先向所有子进程发送 SIGTERM，再统一等待退出
     for proc in processes:
         try:
             proc.terminate()
+        except Exception as e:
+            print(f"清理进程时出错: {e}")
+
+    for proc in processes:
+        try:
             proc.wait(timeout=5)
         except subprocess.TimeoutExpired:
             proc.kill()
         except Exception as e:
             print(f"清理进程时出错: {e}")
 
-    # 清理测试数据
-    import shutil
+    # 清理测试数据和日志文件
+    artifacts = ["test_data", "node1.log", "node2.log"]
+    if sys.platform != "win32":
+        subprocess.run(["rm", "-rf", *artifacts], check=False)
+    else:
+        # atexit 阶段线程池已关闭，不能再提交任务
+        import shutil
 
-    if os.path.exists("test_data"):
-        shutil.rmtree("test_data")
-
-    # 清理日志文件
-    for log_file in ["node1.log", "node2.log"]:
-        if os.path.exists(log_file):
-            os.remove(log_file)
+        for path in artifacts:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
 
     print_colored("✓ 清理完成", Colors.GREEN)
 
@@ -74,38 +162,51 @@ def cleanup():
 def signal_handler(signum, frame):
     """信号处理器"""
     print_colored("\n收到中断信号，清理并退出...", Colors.YELLOW)
+    # 立即清理并通知轮询线程退出，避免线程池退出时等待轮询超时
     cleanup()
-    sys.exit(0)
+    sys.exit(130)
 
 
 def check_port(port: int) -> bool:
-    """检查端口是否可用"""
+    """检查端口是否可用（尝试绑定端口）"""
     import socket
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex(("127.0.0.1", port))
-    sock.close()
-    return result != 0
+    # Windows 上 SO_REUSEADDR 允许绑定正在监听的端口，需改用独占绑定
+    if sys.platform == "win32":
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(("127.0.0.1", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
 
 
 def wait_for_service(port: int, max_wait: int = TIMEOUT) -> bool:
-    """等待服务启动"""
+    """等待服务启动（指数退避轮询）"""
     print_colored(f"等待端口 {port} 上的服务启动...", Colors.YELLOW)
 
-    for i in range(max_wait):
+    deadline = time.monotonic() + max_wait
+    delay = 0.02
+    while not _stop.is_set() and time.monotonic() < deadline:
         try:
-            response = requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            response = SESSION.get(ENDPOINTS[port]["health"], timeout=0.25)
             if response.status_code == 200:
                 print_colored(f"✓ 端口 {port} 上的服务已启动", Colors.GREEN)
                 return True
         except requests.exceptions.RequestException:
             pass
 
-        print(".", end="", flush=True)
-        time.sleep(1)
+        _stop.wait(delay)
+        delay = min(delay * 1.7, 0.5)
 
-    print()
-    print_colored("✗ 服务启动超时", Colors.RED)
+    if _stop.is_set():
+        return False
+    print_colored(f"✗ 端口 {port} 上的服务启动超时", Colors.RED)
     return False
 
 
@@ -115,11 +216,9 @@ def start_node(
     """启动节点"""
     Path(data_path).mkdir(parents=True, exist_ok=True)
 
+    # 步骤 0 已完成编译，直接运行产物，避免 cargo 的额外启动开销
     cmd = [
-        "cargo",
-        "run",
-        "--release",
-        "--",
+        str(BINARY),
         "--port",
         str(port),
         "--node-id",
@@ -128,13 +227,17 @@ def start_node(
         data_path,
     ]
 
-    with open(log_file, "w") as log:
+    # 子进程直接写入原始文件描述符，父进程在 Popen 复制后即可关闭
+    fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
         proc = subprocess.Popen(
             cmd,
-            stdout=log,
+            stdout=fd,
             stderr=subprocess.STDOUT,
-            preexec_fn=os.setsid if sys.platform != "win32" else None,
+            start_new_session=(sys.platform != "win32"),
         )
+    finally:
+        os.close(fd)
 
     processes.append(proc)
     return proc
@@ -142,66 +245,84 @@ def start_node(
 
 def post_sync(port: int, changes: List[Dict]) -> Dict:
     """提交变更到节点"""
-    url = f"http://127.0.0.1:{port}/sync"
-    response = requests.post(url, json={"changes": changes})
-    response.raise_for_status()
-    return response.json()
+    url = ENDPOINTS[port]["sync"]
+    body = encode_json({"changes": changes})
+    response = SESSION.post(url, data=body, headers=JSON_HEADERS)
+    if response.status_code != 200:
+        response.raise_for_status()
+    return parse_json(response.content)
 
 
 def get_state_hash(port: int) -> str:
     """获取节点状态哈希"""
-    url = f"http://127.0.0.1:{port}/state-hash"
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()["hash"]
+    url = ENDPOINTS[port]["state-hash"]
+    response = SESSION.get(url)
+    if response.status_code != 200:
+        response.raise_for_status()
+    return parse_json(response.content)["hash"]
+
+
+def wait_converge(port: int, expected: str, deadline_s: float = SYNC_TIMEOUT) -> str:
+    """轮询节点状态哈希直到与期望值一致或超时，返回最后一次读取到的哈希"""
+    deadline = time.monotonic() + deadline_s
+    current = get_state_hash(port)
+    while current != expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+        current = get_state_hash(port)
+    return current
 
 
 def get_state(port: int) -> Dict:
     """获取节点完整状态"""
-    url = f"http://127.0.0.1:{port}/state"
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()
+    url = ENDPOINTS[port]["state"]
+    response = SESSION.get(url)
+    if response.status_code != 200:
+        response.raise_for_status()
+    return parse_json(response.content)
 
 
 def sync_peer(from_port: int, to_port: int) -> Dict:
     """触发节点间同步"""
-    url = f"http://127.0.0.1:{from_port}/sync-peer"
-    response = requests.post(url, json={"peer": f"127.0.0.1:{to_port}"})
-    response.raise_for_status()
-    return response.json()
+    url = ENDPOINTS[from_port]["sync-peer"]
+    body = encode_json({"peer": f"127.0.0.1:{to_port}"})
+    response = SESSION.post(url, data=body, headers=JSON_HEADERS)
+    if response.status_code != 200:
+        response.raise_for_status()
+    return parse_json(response.content)
 
 
 def main():
     """主测试流程"""
-    # 注册信号处理器
+    # 注册退出清理和信号处理器
+    atexit.register(cleanup)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     try:
-        print_colored("=" * 50, Colors.GREEN)
-        print_colored("Silent-CRDT 本地多节点同步测试", Colors.GREEN)
-        print_colored("=" * 50, Colors.GREEN)
+        sys.stdout.write(BANNER)
         print()
 
         # 步骤 0: 检查并编译项目
         print_colored("[步骤 0] 编译项目...", Colors.YELLOW)
-        result = subprocess.run(["cargo", "build", "--release"], capture_output=True)
+        result = subprocess.run(
+            ["cargo", "build", "--release"], cwd=PROJECT_ROOT, capture_output=True
+        )
         if result.returncode != 0:
             print_colored("✗ 编译失败", Colors.RED)
             print(result.stderr.decode())
             return 1
+        if not BINARY.is_file():
+            print_colored(f"✗ 未找到编译产物: {BINARY}", Colors.RED)
+            return 1
         print_colored("✓ 编译完成", Colors.GREEN)
         print()
 
         # 步骤 1: 检查端口可用性
         print_colored("[步骤 1] 检查端口可用性...", Colors.YELLOW)
-        if not check_port(PORT1):
-            print_colored(f"✗ 端口 {PORT1} 已被占用", Colors.RED)
-            return 1
-        if not check_port(PORT2):
-            print_colored(f"✗ 端口 {PORT2} 已被占用", Colors.RED)
-            return 1
+        for port in (PORT1, PORT2):
+            if not check_port(port):
+                print_colored(f"✗ 端口 {port} 已被占用", Colors.RED)
+                return 1
         print_colored("✓ 端口检查通过", Colors.GREEN)
         print()
 
@@ -209,17 +330,30 @@ def main():
         print_colored(f"[步骤 2] 启动节点 1 (端口 {PORT1})...", Colors.YELLOW)
         node1_proc = start_node(PORT1, NODE1_ID, DATA_DIR1, "node1.log")
         print(f"节点 1 PID: {node1_proc.pid}")
-        if not wait_for_service(PORT1):
-            return 1
-        print_colored("✓ 节点 1 启动成功", Colors.GREEN)
         print()
 
         # 步骤 3: 启动节点 2
         print_colored(f"[步骤 3] 启动节点 2 (端口 {PORT2})...", Colors.YELLOW)
         node2_proc = start_node(PORT2, NODE2_ID, DATA_DIR2, "node2.log")
         print(f"节点 2 PID: {node2_proc.pid}")
-        if not wait_for_service(PORT2):
+        print()
+
+        # 两个节点独立启动，并发等待健康检查
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            f1 = executor.submit(wait_for_service, PORT1)
+            f2 = executor.submit(wait_for_service, PORT2)
+            ready1, ready2 = f1.result(), f2.result()
+            if not ready1 or not ready2:
+                return 1
+
+            # 两个节点均以空数据启动，状态哈希相同，记录一次供后续步骤复用
+            f1 = executor.submit(get_state_hash, PORT1)
+            f2 = executor.submit(get_state_hash, PORT2)
+            empty_hash, hash1_initial = f2.result(), f1.result()
+        if hash1_initial != empty_hash:
+            print_colored("✗ 两个节点的初始状态哈希不一致", Colors.RED)
             return 1
+        print_colored("✓ 节点 1 启动成功", Colors.GREEN)
         print_colored("✓ 节点 2 启动成功", Colors.GREEN)
         print()
 
@@ -231,18 +365,16 @@ def main():
             {"op": "set", "key": "status", "value": "active"},
         ]
         response = post_sync(PORT1, changes)
-        print(f"响应: {json.dumps(response, indent=2)}")
+        print(f"响应: {format_json(response)}")
 
         hash1_before = get_state_hash(PORT1)
         print(f"节点 1 状态哈希: {hash1_before}")
         print_colored("✓ 变更提交成功", Colors.GREEN)
         print()
 
-        time.sleep(WAIT_TIME)
-
         # 步骤 5: 获取节点 2 同步前的状态哈希
         print_colored("[步骤 5] 检查节点 2 同步前的状态...", Colors.YELLOW)
-        hash2_before = get_state_hash(PORT2)
+        hash2_before = empty_hash
         print(f"节点 2 状态哈希（同步前）: {hash2_before}")
 
         if hash1_before == hash2_before:
@@ -254,15 +386,13 @@ def main():
         # 步骤 6: 触发节点间同步
         print_colored("[步骤 6] 触发节点 1 -> 节点 2 的同步...", Colors.YELLOW)
         sync_response = sync_peer(PORT1, PORT2)
-        print(f"同步响应: {json.dumps(sync_response, indent=2)}")
+        print(f"同步响应: {format_json(sync_response)}")
         print_colored("✓ 同步请求已发送", Colors.GREEN)
         print()
 
-        time.sleep(WAIT_TIME)
-
         # 步骤 7: 验证节点 2 的状态
         print_colored("[步骤 7] 验证节点 2 的状态...", Colors.YELLOW)
-        hash2_after = get_state_hash(PORT2)
+        hash2_after = wait_converge(PORT2, hash1_before)
         print(f"节点 2 状态哈希（同步后）: {hash2_after}")
         print()
 
@@ -280,13 +410,16 @@ def main():
 
         # 步骤 9: 显示详细状态对比
         print_colored("[步骤 9] 显示详细状态对比...", Colors.YELLOW)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            f1 = executor.submit(get_state, PORT1)
+            f2 = executor.submit(get_state, PORT2)
+            state1, state2 = f1.result(), f2.result()
+
         print("\n=== 节点 1 状态 ===")
-        state1 = get_state(PORT1)
-        print(json.dumps(state1, indent=2))
+        print(format_json(state1))
 
         print("\n=== 节点 2 状态 ===")
-        state2 = get_state(PORT2)
-        print(json.dumps(state2, indent=2))
+        print(format_json(state2))
         print()
 
         # 步骤 10: 测试反向同步
@@ -294,15 +427,11 @@ def main():
         print("向节点 2 添加新数据...")
         post_sync(PORT2, [{"op": "add", "key": "user", "value": "Bob"}])
 
-        time.sleep(WAIT_TIME)
-
+        # 变更在节点 2 上同步应用，可直接触发同步
         print("触发节点 2 -> 节点 1 的同步...")
         sync_peer(PORT2, PORT1)
-
-        time.sleep(WAIT_TIME)
-
-        hash1_final = get_state_hash(PORT1)
         hash2_final = get_state_hash(PORT2)
+        hash1_final = wait_converge(PORT1, hash2_final)
 
         print(f"最终节点 1 哈希: {hash1_final}")
         print(f"最终节点 2 哈希: {hash2_final}")
@@ -315,9 +444,7 @@ def main():
         print()
 
         # 测试完成
-        print_colored("=" * 50, Colors.GREEN)
-        print_colored("✓✓✓ 所有测试通过！", Colors.GREEN)
-        print_colored("=" * 50, Colors.GREEN)
+        sys.stdout.write(SUCCESS_BANNER)
         print()
         print("日志文件：")
         print("  - 节点 1: node1.log")
@@ -331,8 +458,6 @@ def main():
 
         traceback.print_exc()
         return 1
-    finally:
-        cleanup()
 
 
 if __name__ == "__main__":